@@ -11,6 +11,10 @@ Instead, copy it, then edit the copy.
 WEEREG_MYSQL_USER = 'weewx'
 WEEREG_MYSQL_PASSWORD = 'weewx'
 
+# How many idle database connections to keep around for reuse. Registrations use a
+# separate pool of the same size.
+WEEREG_MYSQL_POOL_SIZE = 10
+
 # How often a station can post.
 # It should be slightly less than client's post_interval.
 WEEREG_MIN_DELAY = 3600 * 23
@@ -22,6 +26,9 @@ SCREEN_CAPTURE_TIMEOUT = 180
 WEEREG_STATIONS_MAX_AGE = 3600 * 24 * 30  # = One month
 WEEREG_STATIONS_LIMIT = 2000
 
+# How long to reuse the results of GET /api/v2/stats/<info_type>, in seconds
+WEEREG_STATS_CACHE_TTL = 60
+
 WEEREG_LOGGING = {
     'version': 1,
     'formatters': {
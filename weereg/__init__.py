@@ -9,8 +9,14 @@ See README.md for how to set up and use.
 """
 __version__ = "1.9.3"
 
+import atexit
+import collections
+import concurrent.futures
+import functools
 import logging.config
+import logging.handlers
 import os.path
+import queue
 import re
 import signal
 import subprocess
@@ -18,9 +24,12 @@ import threading
 import time
 from dataclasses import dataclass
 
+import cachetools
+import orjson
 import pymysql.err
 import validators.url
-from flask import Flask, request, current_app
+from flask import Flask, Response, current_app, g, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 
 from . import db
 
@@ -31,6 +40,38 @@ class RejectStation(Exception):
     code: int
 
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Serialize and parse JSON using orjson, which is much faster than the standard library.
+
+    The results are the same as Flask's default provider: keys are sorted, and types that JSON
+    does not know about (such as Decimal) are converted by the same default function.
+    """
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        # orjson.JSONDecodeError is a subclass of ValueError, so badly formed requests are
+        # still caught by request.get_json(silent=True).
+        return orjson.loads(s)
+
+
+# Screen captures run in this pool of threads. This reuses the threads, and limits how many
+# captures can run at once if a lot of new stations show up together.
+capture_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='capture')
+
+# Types that a JSON value can have, other than objects and arrays
+json_scalar_types = (str, int, float, type(None))
+
+# The types of information that statistics can be requested for
+stats_info_types = frozenset({"station_type", "station_model", "weewx_info", "python_info",
+                              "platform_info", "config_path", "entry_path"})
+
 PARENT_DIR = os.path.join(os.path.dirname(__file__), '..')
 
 
@@ -38,11 +79,15 @@ def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__, instance_path=PARENT_DIR,
                 instance_relative_config=True)
+    app.json = ORJSONProvider(app)
     # Set up useful defaults
     app.config.from_mapping(
         WEEREG_MYSQL_HOST='localhost',
         WEEREG_MYSQL_PORT=3306,
-        WEEREG_MYSQL_DATABASE='weereg'
+        WEEREG_MYSQL_DATABASE='weereg',
+        WEEREG_MYSQL_POOL_SIZE=10,
+        # A registration is well under 1kB. Refuse anything unreasonably large.
+        MAX_CONTENT_LENGTH=64 * 1024,
     )
 
     # Override the defaults
@@ -58,59 +103,119 @@ def create_app(test_config=None):
             raise e
 
     logging.config.dictConfig(app.config.get('WEEREG_LOGGING'))
+    # Do the actual writing of log records in a separate thread, so requests don't wait on it.
+    log_in_background()
+
+    # These options are used on every request, and do not change once the app is running.
+    # Look them up just once.
+    min_delay = app.config.get("WEEREG_MIN_DELAY", 23 * 3600)
+    stations_max_age = app.config.get("WEEREG_STATIONS_MAX_AGE", "30d")
+    stations_limit = app.config.get("WEEREG_STATIONS_LIMIT", 2000)
+    capture_timeout = app.config.get('SCREEN_CAPTURE_TIMEOUT')
+    stats_cache_ttl = app.config.get('WEEREG_STATS_CACHE_TTL', 60)
+
+    # When stations were last seen, as far as this process knows. A station can't register
+    # again until min_delay has passed, so there is no point keeping entries any longer.
+    recent_stations = cachetools.TTLCache(maxsize=10_000, ttl=min_delay)
+    recent_lock = threading.Lock()
+
+    # Recent results of the statistics query, which is expensive. They change slowly, so it
+    # does no harm if they are a little stale. Keyed by the request parameters.
+    stats_cache = cachetools.TTLCache(maxsize=256, ttl=stats_cache_ttl)
+    stats_lock = threading.Lock()
+
+    @app.before_request
+    def stamp_time():
+        """Note the time of the request, rounded to the nearest second, for use by the views."""
+        g.now = (time.time_ns() + 500_000_000) // 1_000_000_000
 
     # Legacy "v1", using GET method:
     @app.get('/api/v1/stations', strict_slashes=False)
     def add_v1_station():
         """Add a station registration to the database."""
-        station_info = request.args.to_dict()
+        # Keep only the parameters that are columns in the database. Anything else is ignored.
+        station_info = {key: value for key, value in request.args.items()
+                        if key in db.STATION_INFO}
         return _register_station(station_info)
 
     # V2 version, using POST method
     @app.post('/api/v2/stations', strict_slashes=False)
     def add_v2_station():
-        station_info = request.get_json()
+        # Don't bother caching the parsed body. We only use it once.
+        body = request.get_json(silent=True, cache=False)
+        if not isinstance(body, dict):
+            return "Badly formed request", 400
+        # Keep only the columns in the database. The database driver cannot take JSON objects
+        # or arrays as values, so store them as text.
+        station_info = {key: value if isinstance(value, json_scalar_types) else str(value)
+                        for key, value in body.items() if key in db.STATION_INFO}
         return _register_station(station_info)
 
     def _register_station(station_info):
         """Register a station
 
         Args:
-            station_info(dict): Holds the station information. The only required key
-                is 'station_url'.
+            station_info(dict): Holds the station information. The required keys are
+                'station_url', 'latitude', and 'longitude'.
         Returns:
             str|tuple: String 'OK' if successful, otherwise, a
                 tuple (error message, response code)
         """
 
-        station_info['last_seen'] = int(time.time() + 0.5)
-        station_info['last_addr'] = request.remote_addr
+        logger = app.logger
 
-        station_info = sanitize_station(station_info, app.logger)
         try:
-            last_seen = check_station(app, station_info)
+            # Turn away obviously incomplete registrations before doing any work on them.
+            check_required(app, station_info)
+
+            # The time of the request, as noted by stamp_time().
+            station_info['last_seen'] = g.now
+            station_info['last_addr'] = request.remote_addr
+
+            station_info = sanitize_station(station_info, logger)
+            check_station(app, station_info)
         except RejectStation as eject:
             return eject.reason, eject.code
+        station_url = station_info['station_url']
+
+        # Cannot post too frequently. If we've seen the station recently ourselves, we can turn
+        # it away without going to the database.
+        with recent_lock:
+            last_seen = recent_stations.get(station_url)
+        if last_seen is None or station_info['last_seen'] - last_seen >= min_delay:
+            # The database has the final say. The check and the insert are done in one go.
+            try:
+                inserted, last_seen = db.insert_if_not_recent(station_info, min_delay)
+            except pymysql.err.DatabaseError as e:
+                logger.error(e)
+                return "Internal error", 500
+            with recent_lock:
+                recent_stations[station_url] = station_info['last_seen'] if inserted else last_seen
+        else:
+            inserted = False
 
-        try:
-            db.insert_into_stations(station_info)
-        except pymysql.err.DatabaseError as e:
-            app.logger.error(e)
-            return "Internal error", 500
+        if not inserted:
+            how_long = station_info['last_seen'] - last_seen
+            if 'weewx_info' in station_info:
+                version = f"v{station_info['weewx_info']}"
+            else:
+                version = "N/A"
+            logger.info("Station %s (%s) is registering too frequently (%ss)",
+                        station_url, version, how_long)
+            return "FAIL. Registering too frequently", 429
 
-        app.logger.info(f"Received registration from station {station_info['station_url']}; "
-                        f"version {station_info.get('weewx_info', 'N/A')}; "
-                        f"({station_info['last_addr']})")
+        logger.info("Received registration from station %s; version %s; (%s)",
+                    station_url, station_info.get('weewx_info', 'N/A'),
+                    station_info['last_addr'])
 
         # If the staton has never been seen before, do a screen capture.
         if not last_seen:
-            _capture_station(station_info['station_url'],
-                             app.config.get('SCREEN_CAPTURE_TIMEOUT'))
+            _capture_station(station_url, capture_timeout)
 
         return "OK"
 
     def _capture_station(station_url, timeout=None):
-        """Kick off the screenshot capture process in a separate thread.
+        """Kick off the screenshot capture process in a thread from the capture pool.
 
         Args:
             station_url (str): The unique identifier to be used by a station.
@@ -132,23 +237,34 @@ def create_app(test_config=None):
                 # Run the capture shell command.
                 p = subprocess.Popen(["/var/www/html/register/capture-one.sh", station_url],
                                      start_new_session=True)
-                # Wait for the subprocess to terminate. Give up after "timeout" seconds.
-                p.wait(timeout=timeout)
                 # We're inside a thread, so we cannot use the Flask app logger.
                 # Use the standard logging module.
-                log.info(f"Kicked off screen capture for station {station_url}")
+                log.info("Kicked off screen capture for station %s", station_url)
+                # Wait for the subprocess to terminate. Give up after "timeout" seconds.
+                p.wait(timeout=timeout)
             except FileNotFoundError:
                 log.error("Could not find screen capture app")
-            except subprocess.TimeoutError:
-                log.error(f"Screen capture for station {station_url} "
-                          f"timed out after {timeout} seconds.")
-                log.error(f"Terminating the process group with PID={p.pid}.")
-                os.killpg(os.getpgid(p.pid), signal.SIGTERM)
-
-        thread = threading.Thread(target=_do_capture)
-        # Start the thread, but don't wait around to 'join' it. We don't care if it succeeds
-        # or fails.
-        thread.start()
+            except subprocess.TimeoutExpired:
+                log.error("Screen capture for station %s timed out after %s seconds.",
+                          station_url, timeout)
+                log.error("Terminating the process group with PID=%s.", p.pid)
+                # The subprocess was started in a new session, so its process group ID is its
+                # PID.
+                os.killpg(p.pid, signal.SIGTERM)
+                # Reap the child, so it does not linger as a zombie. If it won't go quietly,
+                # kill it, rather than tie up a thread of the capture pool forever.
+                try:
+                    p.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    log.error("Killing the process group with PID=%s.", p.pid)
+                    os.killpg(p.pid, signal.SIGKILL)
+                    p.wait()
+
+        # Hand the capture off to the pool, but don't wait around for the result. We don't care
+        # if it succeeds or fails, but do log anything unexpected. Otherwise, the pool would
+        # swallow the exception.
+        future = capture_pool.submit(_do_capture)
+        future.add_done_callback(_log_capture_exception)
 
     @app.get('/api/v2/stations', strict_slashes=False)
     def get_stations():
@@ -160,22 +276,20 @@ def create_app(test_config=None):
                     return "Specify 'max_age' or 'since', but not both", 400
                 since = int(request.args['since'])
             else:
-                since = duration(request.args.get('max_age',
-                                                  current_app.config.get(
-                                                      "WEEREG_STATIONS_MAX_AGE", "30d")))
-            limit = int(request.args.get('limit',
-                                         current_app.config.get("WEEREG_STATIONS_LIMIT", 2000)))
+                since = duration(request.args.get('max_age', stations_max_age), g.now)
+            limit = int(request.args.get('limit', stations_limit))
         except ValueError:
             return "Badly formed request", 400
 
-        results = [stn for stn in db.gen_stations_since(since, limit)]
-        return results
+        stations = db.gen_stations_since(since, limit)
+        # Stream the results, rather than build them all in memory first.
+        return Response(stream_with_context(json_list_stream(stations)),
+                        mimetype='application/json')
 
     @app.get('/api/v2/stats/<info_type>')
     def get_stats(info_type: str):
         """Get usage statistics"""
-        if info_type not in {"station_type", "station_model", "weewx_info", "python_info",
-                             "platform_info", "config_path", "entry_path"}:
+        if info_type not in stats_info_types:
             return "Invalid info type", 400
         try:
             if 'since' in request.args and 'max_age' in request.args:
@@ -183,15 +297,24 @@ def create_app(test_config=None):
             elif 'since' in request.args:
                 since = int(request.args['since'])
             elif 'max_age' in request.args:
-                since = duration(request.args.get('max_age'))
+                since = duration(request.args.get('max_age'), g.now)
             else:
                 since = None
         except ValueError:
             return "Badly formed request", 400
 
-        results = db.get_stats(info_type, start_time=since)
-
-        # If requested, consolidate the results.
+        # The key uses the parameters as given, because the value of 'since' computed from
+        # 'max_age' changes every second.
+        key = (info_type, request.args.get('since'), request.args.get('max_age'))
+        with stats_lock:
+            results = stats_cache.get(key)
+        if results is None:
+            results = db.get_stats(info_type, start_time=since)
+            with stats_lock:
+                stats_cache[key] = results
+
+        # If requested, consolidate the results. This returns a new dictionary, leaving the
+        # cached results untouched.
         if 'consolidate' in request.args:
             results = consolidate(info_type, results)
 
@@ -202,94 +325,159 @@ def create_app(test_config=None):
     return app
 
 
+def _log_capture_exception(future):
+    """Log any exception raised by a screen capture run in the capture pool."""
+    exc = future.exception()
+    if exc is not None:
+        logging.getLogger(__name__).error("Screen capture failed", exc_info=exc)
+
+
+def log_in_background():
+    """Put the handlers of the root logger behind a queue, serviced by a background thread.
+
+    Logging calls still merge the message with its arguments (QueueHandler.prepare() does
+    that on the calling thread), but then only have to put the record on the queue. The
+    handlers' own formatting and the (slow) file I/O happen in the background thread.
+    """
+    root = logging.getLogger()
+    if not root.handlers:
+        return
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers,
+                                              respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    # Make sure any queued records get written out when we exit.
+    atexit.register(listener.stop)
+
+
+bound_method_re = re.compile(r"bound method (\w+)[. ]")
+
+# Translation table that deletes carriage returns, newlines, and double-quotes
+sanitize_table = str.maketrans('', '', '\r\n"')
+
+
+def normpath(path):
+    """Same as os.path.normpath(), but quickly returns paths that are already normalized.
+
+    A path is already normalized if it is not empty, has no empty, '.', or '..' components,
+    and has no trailing slash. That is the case for nearly all paths sent by stations.
+    """
+    if path and not (path.startswith('.') or path.endswith('/') or '//' in path
+                     or '/.' in path):
+        return path
+    return os.path.normpath(path)
+
+
 def sanitize_station(station_info, logger):
     """Correct any obvious errors in the station information"""
 
     # Get rid of carriage returns, newlines, and double-quotes. Single quotes are OK,
     # because they might be part of a name (e.g., Land's End).
-    for key in station_info:
-        if isinstance(station_info[key], str):
-            station_info[key] = station_info[key] \
-                .strip() \
-                .replace("\n", "") \
-                .replace("\r", "") \
-                .replace('"', "")
+    for key, value in station_info.items():
+        if isinstance(value, str):
+            # Most values are already clean. If there is nothing to strip, strip() returns the
+            # same object, and the translation can be skipped entirely.
+            clean = value.strip()
+            if '\n' in clean or '\r' in clean or '"' in clean:
+                clean = clean.translate(sanitize_table)
+            if clean is not value:
+                station_info[key] = clean
 
     if 'station_model' in station_info:
         # Salvage the driver name out of any "bound method" station models.
-        match = re.search(r"bound method (\w+)[. ]", station_info['station_model'])
+        match = bound_method_re.search(station_info['station_model'])
         if match:
             station_info['station_model'] = match.group(1)
 
     # For config_path and entry_path, normalize them, then make sure they are not longer than
     # the space allocated for them in the database.
     if 'config_path' in station_info:
-        station_info['config_path'] = os.path.normpath(station_info['config_path'])
+        station_info['config_path'] = normpath(station_info['config_path'])
         if len(station_info['config_path']) > 64:
             station_info['config_path'] = station_info['config_path'][:64]
-            logger.debug(f"Station {station_info['station_url']}: trimmed 'config_path'.")
+            logger.debug("Station %s: trimmed 'config_path'.", station_info['station_url'])
     if 'entry_path' in station_info:
-        station_info['entry_path'] = os.path.normpath(station_info['entry_path'])
+        station_info['entry_path'] = normpath(station_info['entry_path'])
         if len(station_info['entry_path']) > 64:
             station_info['entry_path'] = station_info['entry_path'][:64]
-            logger.debug(f"Station {station_info['station_url']}: trimmed 'entry_path'.")
+            logger.debug("Station %s: trimmed 'entry_path'.", station_info['station_url'])
 
     return station_info
 
 
-def check_station(app, station_info):
-    """Perform some basic quality checks on a station.
+# Matches the common kind of station URL: http or https, a domain name, an optional port, and
+# an optional path. Any URL it matches is also accepted by validators.url().
+simple_url_re = re.compile(r"""
+                    https?://
+                    (?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}   # Domain name
+                    (?::[1-9][0-9]{0,3})?                                     # Optional port
+                    (?:/[-a-z0-9._~!$&'()*+,;=:@%/]*)?                        # Optional path
+                    """, re.X | re.I | re.A)
+
+
+@functools.lru_cache(maxsize=10_000)
+def is_valid_url(url):
+    """Return True if url is a valid URL. Most URLs are simple enough to be checked with a
+    regular expression. Only the rest use the much slower validators.url(). The same stations
+    register over and over, so the results are cached."""
+    return bool(simple_url_re.fullmatch(url) or validators.url(url))
+
+
+# Station URLs containing any of these are not serious
+silly_url_re = re.compile(r"weewx\.com|example\.com|register\.cgi")
+
+
+def check_required(app, station_info):
+    """Make sure the station information includes a station_url. This is cheap enough to be
+    done before the station information is sanitized. Latitude and longitude are checked by
+    check_station(), after station_url has been validated.
 
     Args:
         app (Flask): A flask application object
         station_info (dict): Station information from the client
 
-    Returns:
-        float|None: The last time the station was seen, or None if it has never been seen.
-
     Raises:
-        RejectStation: If the station fails any validations.
+        RejectStation: If station_url is missing.
     """
-
-    # Check station_url. First, we must have one...
     if 'station_url' not in station_info:
         app.logger.info("Missing parameter station_url")
         raise RejectStation("FAIL. Missing parameter station_url", 200)
-    # ... it must be valid ...
-    if not validators.url(station_info['station_url']):
-        app.logger.info(f"Invalid station_url {station_info['station_url']}")
+
+
+def check_station(app, station_info):
+    """Perform some basic quality checks on a station. The presence of station_url must
+    already have been checked by check_required().
+
+    Args:
+        app (Flask): A flask application object
+        station_info (dict): Station information from the client
+
+    Raises:
+        RejectStation: If the station fails any validations.
+    """
+
+    # Check station_url. First, it must be a valid URL. Results are cached, so this is cheap for
+    # stations that have been seen before. Anything too long for the database is turned away
+    # first, which also keeps the cache from growing without bound.
+    url = station_info['station_url']
+    if not isinstance(url, str) or len(url) > 255 or not is_valid_url(url):
+        app.logger.info("Invalid station_url %s", url)
         raise RejectStation("FAIL. Invalid station_url", 200)
-    # ... and not use a silly name.
-    for reject in ('weewx.com', 'example.com', 'register.cgi'):
-        if reject in station_info['station_url']:
-            app.logger.info(f"Silly station_url {station_info['station_url']}")
-            raise RejectStation(f"FAIL. {station_info['station_url']} is not a "
-                                f"serious station_url", 200)
+    # ... and it must not use a silly name.
+    if silly_url_re.search(url):
+        app.logger.info("Silly station_url %s", url)
+        raise RejectStation("FAIL. Not a serious station_url", 200)
 
     # latitude and longitude have to exist, be convertible to floats, and be in a valid range
     try:
         lat = float(station_info['latitude'])
         lon = float(station_info['longitude'])
-    except (ValueError, KeyError):
+    except (ValueError, TypeError, KeyError):
         raise RejectStation("FAIL. Missing or badly formed latitude or longitude", 200)
     if not -90 <= lat <= 90 or not -180 <= lon <= 180:
         raise RejectStation("FAIL. Latitude or longitude out of range", 200)
 
-    # Cannot post too frequently
-    last_post = db.get_last_seen(station_info['station_url'])
-    if last_post:
-        how_long = station_info['last_seen'] - last_post
-        if how_long < current_app.config.get("WEEREG_MIN_DELAY", 23 * 3600):
-            if 'weewx_info' in station_info:
-                version = f"v{station_info['weewx_info']}"
-            else:
-                version = "N/A"
-            app.logger.info(f"Station {station_info['station_url']} ({version}) is "
-                            f"registering too frequently ({how_long}s)")
-            raise RejectStation("FAIL. Registering too frequently", 429)
-
-    return last_post
-
 
 config_path_re = re.compile(r"""
                     /(home|Users)/      # Accept either /home or /Users
@@ -328,39 +516,64 @@ def consolidate(info_type, result_set):
 
 
 def consolidate_info(matcher, result_set, new_key_fun):
-    # count_dict will be a dictionary of dictionaries. The outer dictionary is keyed by the
-    # info_type value (e.g., for a Python consolidation, perhaps "3.5"). The inner dictionary is
-    # keyed by a timestamp, with the count being the value.
-    count_dict = dict()
-    for info_value in list(result_set.keys()):
+    # count_dict will be a dictionary of Counters. The dictionary is keyed by the consolidated
+    # info_type value (e.g., for a Python consolidation, perhaps "3.5"). Each Counter is keyed
+    # by a timestamp, with the count being the value.
+    count_dict = collections.defaultdict(collections.Counter)
+    # Values that don't match are passed through unchanged.
+    consolidated = dict()
+    for info_value, (times, counts) in result_set.items():
         if m := matcher.match(info_value):
-            new_info_value = new_key_fun(m)
-            if new_info_value not in count_dict:
-                count_dict[new_info_value] = dict()
-            for timestamp, count in zip(result_set[info_value][0], result_set[info_value][1]):
-                count_dict[new_info_value][timestamp] \
-                    = count_dict[new_info_value].get(timestamp, 0) + count
-            del result_set[info_value]
-    # Add the consolidated keys to the result set:
-    for new_key in count_dict:
-        times, counts = zip(*sorted(count_dict[new_key].items()))
-        result_set[new_key] = [times, counts]
-    return result_set
+            count_dict[new_key_fun(m)].update(dict(zip(times, counts)))
+        else:
+            consolidated[info_value] = [times, counts]
+    # Add the consolidated keys:
+    for new_key, counter in count_dict.items():
+        times, counts = zip(*sorted(counter.items()))
+        consolidated[new_key] = [times, counts]
+    return consolidated
+
+
+def json_list_stream(items):
+    """Generate a JSON list, one item at a time.
+
+    Args:
+        items (Iterable): The items to be serialized.
+
+    Yields:
+        str: Chunks of the JSON list.
+    """
+    yield "["
+    separator = ""
+    for item in items:
+        yield separator + current_app.json.dumps(item)
+        separator = ","
+    yield "]"
 
 
 def duration(val, ref_time=None):
-    ref_time = int(ref_time or time.time() + 0.5)
+    ref_time = int(ref_time or (time.time_ns() + 500_000_000) // 1_000_000_000)
     if isinstance(val, str):
-        if val.endswith('y'):
-            delta = int(val[:-1]) * 3600 * 24 * 365
-        elif val.endswith('d'):
-            delta = int(val[:-1]) * 3600 * 24
-        elif val.endswith('h'):
-            delta = int(val[:-1]) * 3600
-        elif val.endswith('M'):
-            delta = int(val[:-1]) * 60
-        else:
-            delta = int(val)
+        delta = _parse_duration(val)
     else:
         delta = val
     return ref_time - delta
+
+
+# Number of seconds for each duration suffix
+duration_units = {
+    'y': 3600 * 24 * 365,
+    'd': 3600 * 24,
+    'h': 3600,
+    'M': 60,
+}
+
+
+@functools.lru_cache(maxsize=128)
+def _parse_duration(val):
+    """Convert a string in duration notation (e.g., "30d") to seconds. There are only a few
+    distinct values in practice, so the results are cached."""
+    unit = duration_units.get(val[-1:])
+    if unit:
+        return int(val[:-1]) * unit
+    return int(val)
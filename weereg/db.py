@@ -1,12 +1,13 @@
 import datetime
+import queue
 import sys
+import time
 
 import click
 import pymysql
+from pymysql.constants import CLIENT
 from flask import current_app, g
 
-from . import db
-
 # The set of data columns in the schema. They can be in any order.
 # TODO: read them dynamically from the databaase.
 STATION_COLUMNS = [
@@ -28,22 +29,74 @@ STATION_COLUMNS = [
 STATION_INFO = frozenset(STATION_COLUMNS)
 
 
+class ConnectionPool:
+    """A simple, thread-safe pool of idle MySQL connections.
+
+    Connections are made on demand. When returned, they are kept for reuse, up to a maximum
+    of 'size' idle connections. Extras are closed.
+    """
+
+    def __init__(self, size=10, ping_after=60, **connect_args):
+        """Initialize the pool.
+
+        Args:
+            size (int): The maximum number of idle connections to keep.
+            ping_after (float): Connections that have been idle longer than this many seconds
+                are pinged, and reconnected if necessary, before being handed out.
+            connect_args (dict): Arguments to be passed on to pymysql.connect().
+        """
+        self.ping_after = ping_after
+        self.connect_args = connect_args
+        # LIFO, so the most recently used (and therefore least likely to be stale) connection
+        # is handed out first.
+        self._idle = queue.LifoQueue(size)
+
+    def get_connection(self):
+        """Borrow a connection from the pool. Make a new one if none are idle."""
+        try:
+            db_conn, released = self._idle.get_nowait()
+        except queue.Empty:
+            return pymysql.connect(**self.connect_args)
+        # The server may have dropped a connection that has been idle for a while (e.g., because
+        # of wait_timeout). Check it, and reconnect if necessary.
+        if time.monotonic() - released > self.ping_after:
+            db_conn.ping(reconnect=True)
+        return db_conn
+
+    def release(self, db_conn):
+        """Return a connection to the pool. If the pool is full, close the connection."""
+        if not db_conn.open:
+            return
+        try:
+            self._idle.put_nowait((db_conn, time.monotonic()))
+        except queue.Full:
+            db_conn.close()
+
+
 def get_db():
     if 'db' not in g:
-        g.db = pymysql.connect(host=current_app.config['WEEREG_MYSQL_HOST'],
-                               port=current_app.config['WEEREG_MYSQL_PORT'],
-                               user=current_app.config['WEEREG_MYSQL_USER'],
-                               passwd=current_app.config['WEEREG_MYSQL_PASSWORD'],
-                               db=current_app.config['WEEREG_MYSQL_DATABASE'],
-                               autocommit=True)
+        g.db = current_app.extensions['weereg_db_pool'].get_connection()
     return g.db
 
 
+def get_multi_db():
+    """Like get_db(), but the connection accepts several statements in one query. Use it only
+    for queries that need that, and never with SQL built out of client input."""
+    if 'multi_db' not in g:
+        g.multi_db = current_app.extensions['weereg_db_multi_pool'].get_connection()
+    return g.multi_db
+
+
 def close_db(e=None):
     db_conn = g.pop('db', None)
 
     if db_conn:
-        db_conn.close()
+        current_app.extensions['weereg_db_pool'].release(db_conn)
+
+    multi_conn = g.pop('multi_db', None)
+
+    if multi_conn:
+        current_app.extensions['weereg_db_multi_pool'].release(multi_conn)
 
 
 def init_db():
@@ -81,64 +134,106 @@ def init_db_command():
 
 
 def init_app(app):
+    connect_args = dict(
+        host=app.config['WEEREG_MYSQL_HOST'],
+        port=app.config['WEEREG_MYSQL_PORT'],
+        user=app.config['WEEREG_MYSQL_USER'],
+        passwd=app.config['WEEREG_MYSQL_PASSWORD'],
+        db=app.config['WEEREG_MYSQL_DATABASE'],
+        autocommit=True,
+    )
+    app.extensions['weereg_db_pool'] = ConnectionPool(
+        size=app.config['WEEREG_MYSQL_POOL_SIZE'], **connect_args)
+    # Separate connections that allow several statements per query, so that
+    # insert_if_not_recent() can do its work in a single round trip. They are kept apart so
+    # that no other query can ever run stacked statements.
+    app.extensions['weereg_db_multi_pool'] = ConnectionPool(
+        size=app.config['WEEREG_MYSQL_POOL_SIZE'],
+        client_flag=CLIENT.MULTI_STATEMENTS,
+        **connect_args)
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
 
 
-def insert_into_stations(station_info):
-    """Insert the station information into the database.
+# Every insert uses the same, fixed column order, so the statement text never changes.
+INSERT_SQL = f"""INSERT INTO weereg.stations ({", ".join(STATION_COLUMNS)})
+VALUES ({", ".join(["%s"] * len(STATION_COLUMNS))})"""
+
+
+def _station_row(station_info):
+    """Return the values of station_info as a tuple, in the order of STATION_COLUMNS. Missing
+    columns are None. Extra keys are ignored."""
+    return tuple(station_info.get(col) for col in STATION_COLUMNS)
+
+
+def insert_many_stations(station_infos):
+    """Insert a batch of station information into the database.
+
+    PyMySQL rewrites this into a single, multi-row INSERT statement.
+
     Args:
-        station_info(dict): Keys are columns in the database.
+        station_infos(list[dict]): Each dictionary is keyed by columns in the database.
     """
 
-    # This is the set of types in station_info that are also in the schema
-    to_insert = STATION_INFO.intersection(station_info)
+    rows = [_station_row(station_info) for station_info in station_infos]
+    if not rows:
+        return True
 
-    # Get a list of sql type names and a list of their values.
-    # Make sure the values are in quotation marks, because they might contain spaces.
-    pairs = [(k, f'"{station_info[k]}"') for k in to_insert]
-    columns, values = zip(*pairs)
-    sql_stmt = f'INSERT INTO weereg.stations ({", ".join(columns)}) VALUES ({", ".join(values)});'
-
-    db_conn = db.get_db()
+    db_conn = get_db()
     with db_conn.cursor() as cursor:
-        cursor.execute(sql_stmt)
+        cursor.executemany(INSERT_SQL, rows)
 
     return True
 
 
-def get_last_seen(station_url):
-    """Return the last time a station reported in.
+# Look up when the station was last seen, then insert the new registration only if that
+# was long enough ago. Sent as one multi-statement query, so it takes a single round trip.
+INSERT_IF_NOT_RECENT_SQL = f"""SET @last_seen = (SELECT MAX(last_seen) FROM weereg.stations
+                  WHERE station_url = %s);
+INSERT INTO weereg.stations ({", ".join(STATION_COLUMNS)})
+SELECT {", ".join(["%s"] * len(STATION_COLUMNS))} FROM DUAL
+WHERE @last_seen IS NULL OR @last_seen <= %s;
+SELECT @last_seen, ROW_COUNT();"""
+
+
+def insert_if_not_recent(station_info, min_delay):
+    """Insert the station information, unless the station has registered too recently.
 
     Args:
-        station_url(str): The unique URL for the station.
+        station_info(dict): Keys are columns in the database. Must include 'station_url' and
+            'last_seen'.
+        min_delay(int): Minimum time in seconds between registrations from the same station.
 
     Returns:
-        int|None: Time it was last seen in unix epoch time, or None if it has never been seen.
+        tuple[bool, int|None]: Whether the station information was inserted, and the time the
+            station was previously seen (None if it has never been seen).
     """
-    db_conn = db.get_db()
+    args = (station_info['station_url'],) \
+        + _station_row(station_info) \
+        + (station_info['last_seen'] - min_delay,)
+
+    db_conn = get_multi_db()
     with db_conn.cursor() as cursor:
-        cursor.execute('SELECT last_seen FROM weereg.stations WHERE station_url=%s '
-                       'ORDER BY last_seen DESC LIMIT 1',
-                       station_url)
-        result = cursor.fetchone()
-        last_seen = result[0] if result else None
-        return last_seen
-
-
-# Prepare for the inner join:
-t_list = ["t.%s" % col for col in STATION_COLUMNS]
-# Form it:
-STATIONS_SINCE_SQL = f"""SELECT {", ".join(t_list)}
-FROM weereg.stations t
-INNER JOIN (
-    SELECT station_url, MAX(last_seen) as MaxSeen
+        cursor.execute(INSERT_IF_NOT_RECENT_SQL, args)
+        # Skip the results of the SET and INSERT statements
+        cursor.nextset()
+        cursor.nextset()
+        last_seen, row_count = cursor.fetchone()
+        return row_count == 1, last_seen
+
+
+# For each station seen since a given time, pick its most recent row. Requires MySQL 8.0
+# or later, for the window function.
+STATIONS_SINCE_SQL = f"""SELECT {", ".join(STATION_COLUMNS)}
+FROM (
+    SELECT {", ".join(STATION_COLUMNS)},
+           ROW_NUMBER() OVER (PARTITION BY station_url ORDER BY last_seen DESC) AS rn
     FROM weereg.stations
     WHERE last_seen > %s
-    GROUP BY station_url
-    LIMIT %s
-) tm ON t.station_url = tm.station_url AND t.last_seen = tm.MaxSeen
+) latest
+WHERE rn = 1
 ORDER BY last_seen ASC
+LIMIT %s
 """
 
 
@@ -154,12 +249,11 @@ def gen_stations_since(since=0, limit=None):
     """
     limit = limit or 2000
 
-    db_conn = db.get_db()
-    with db_conn.cursor() as cursor:
+    db_conn = get_db()
+    # Use an unbuffered cursor, so rows are fetched from the server as they are needed.
+    with db_conn.cursor(pymysql.cursors.SSDictCursor) as cursor:
         cursor.execute(STATIONS_SINCE_SQL, (since, limit))
-        for result in cursor.fetchall():
-            d = dict(zip(STATION_COLUMNS, result))
-            yield d
+        yield from cursor
 
 
 def get_stats(info_type, start_time=None, batch_size=7):
@@ -176,43 +270,50 @@ def get_stats(info_type, start_time=None, batch_size=7):
             time [ [time1, time2, ...], [count1, count2, ...] ]
 
     """
-    db_conn = db.get_db()
+    db_conn = get_db()
     with db_conn.cursor() as cursor:
         # Get the last date in the dataset
         cursor.execute("SELECT MAX(last_seen) FROM weereg.stations")
         max_timestamp = cursor.fetchone()[0]
         last_date = datetime.date.fromtimestamp(max_timestamp)
-        interp_dict = {
-            'info_type': info_type,
-            'stop_date': last_date,
-            'batch_size': batch_size,
-            'start_clause': f"WHERE last_seen >= {start_time}" if start_time else "",
-        }
-
-        sql = """
-        SELECT batch,
-               TRUNCATE(UNIX_TIMESTAMP(DATE_ADD('%(stop_date)s', INTERVAL - %(batch_size)s * batch + 1 DAY)), 0),
-               %(info_type)s,
-               COUNT(*)
-        FROM weereg.stations t
-        INNER JOIN (
-            SELECT station_url,
-                   TRUNCATE((DATEDIFF('%(stop_date)s',
-                                      FROM_UNIXTIME(last_seen)))/ %(batch_size)s, 0) as batch,
-                   MAX(last_seen) as MaxSeen
-            FROM weereg.stations
-            %(start_clause)s
-            GROUP BY batch, station_url
-        ) last_stns
-        ON t.station_url = last_stns.station_url
-        AND t.last_seen = last_stns.MaxSeen
-        GROUP BY last_stns.batch, %(info_type)s
-        ORDER BY %(info_type)s, last_stns.batch DESC;
-        """ % interp_dict
-
-        cursor.execute(sql)
+
+    # The column name cannot be passed as a query parameter, so it has to be formatted into
+    # the SQL. Make sure it really is a column. Everything else is passed as a parameter.
+    if info_type not in STATION_INFO:
+        raise ValueError(f"Unknown info_type {info_type}")
+    params = {
+        'stop_date': last_date,
+        'batch_size': int(batch_size),
+        'start_time': start_time,
+    }
+    start_clause = "WHERE last_seen >= %(start_time)s" if start_time else ""
+
+    sql = f"""
+    SELECT batch,
+           TRUNCATE(UNIX_TIMESTAMP(DATE_ADD(%(stop_date)s, INTERVAL - %(batch_size)s * batch + 1 DAY)), 0),
+           {info_type},
+           COUNT(*)
+    FROM weereg.stations t
+    INNER JOIN (
+        SELECT station_url,
+               TRUNCATE((DATEDIFF(%(stop_date)s,
+                                  FROM_UNIXTIME(last_seen)))/ %(batch_size)s, 0) as batch,
+               MAX(last_seen) as MaxSeen
+        FROM weereg.stations
+        {start_clause}
+        GROUP BY batch, station_url
+    ) last_stns
+    ON t.station_url = last_stns.station_url
+    AND t.last_seen = last_stns.MaxSeen
+    GROUP BY last_stns.batch, {info_type}
+    ORDER BY {info_type}, last_stns.batch DESC;
+    """
+
+    # Use an unbuffered cursor, so rows are fetched from the server as they are needed.
+    with db_conn.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute(sql, params)
         results = dict()
-        for row in cursor.fetchall():
+        for row in cursor:
             # Deconstruct the row
             batch, stop, value, count = row
             # Some info_types can be None, which the JSON sorting algorithm doesn't like.
@@ -14,7 +14,7 @@ CREATE TABLE weereg.stations (
   `entry_path` varchar(64) DEFAULT NULL,
   `last_addr` varchar(44) NOT NULL,
   `last_seen` int NOT NULL,
-  KEY `index_station_url` (`station_url`),
+  KEY `index_url_seen` (`station_url`, `last_seen`),
   KEY `index_last_seen` (`last_seen`),
   KEY `index_ip` (`last_addr`)
 ) ENGINE=MyISAM DEFAULT CHARSET=latin1;
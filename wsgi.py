@@ -1,21 +1,28 @@
 """Exposes the app to a WSGI server."""
+import logging
+
 import weereg
-import pprint
 
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 
 class PrintingMiddleware(object):
-    """Useful for printing every request."""
+    """Useful for logging every request. Records are logged at level DEBUG."""
 
     def __init__(self, app):
         self._app = app
+        # Look up the logger only now, after the app has configured logging. A logger that
+        # existed before then would have been disabled by dictConfig().
+        self._log = logging.getLogger('wsgi.trace')
 
     def __call__(self, env, resp):
-        pprint.pprint(f"Incoming environment: {env}")
+        if not self._log.isEnabledFor(logging.DEBUG):
+            return self._app(env, resp)
+
+        self._log.debug("Incoming environment: %r", env)
 
         def log_response(status, headers, *args):
-            pprint.pprint(f"Response status: {status}, headers: {headers}")
+            self._log.debug("Response status: %s, headers: %r", status, headers)
             return resp(status, headers, *args)
 
         return self._app(env, log_response)
@@ -28,7 +35,7 @@ weereg = weereg.create_app()
 # See https://flask.palletsprojects.com/en/2.2.x/deploying/proxy_fix/
 weereg.wsgi_app = ProxyFix(weereg.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
-# Uncomment the following to print details about every request:
+# Uncomment the following to log details about every request:
 # weereg.wsgi_app = PrintingMiddleware(weereg.wsgi_app)
 
 if __name__ == '__main__':